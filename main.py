@@ -12,12 +12,36 @@ import random
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
-from typing import Dict, List
+from itertools import islice
+from typing import Dict, List, Tuple
 
 import feedparser
 import requests
 
+# partial/naive URL regex based on: https://stackoverflow.com/a/3809435
+# tweaked to disallow some training punctuation
+_URL_RE = re.compile(
+    rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
+)
+_TAG_RE = re.compile(r"<[^>]+>")
+_LEAD_SENTENCE_RE = re.compile(r"^.*?\.")
+# in Sociological Science, the tag-stripped abstract sits between an 'Abstract' heading and a 'Close' button
+_SOCSCI_RE = re.compile(r"Abstract(.*)Close", re.S)
+
+# journals whose abstracts start with a sentence that is not part of the abstract
+_LEADING_DOT_JOURNALS = frozenset(
+    {
+        "Socius",
+        "American Sociological Review (AoP)",
+        "American Sociological Review",
+        "Sociological Methodology",
+        "Sociological Methods and Research",
+    }
+)
+
 
 def bsky_login_session(pds_url: str, handle: str, password: str) -> Dict:
     """login to blueksy
@@ -38,6 +62,27 @@ def bsky_login_session(pds_url: str, handle: str, password: str) -> Dict:
     return resp.json()
 
 
+# logged in sessions, keyed by (pds_url, handle)
+_session_cache: Dict[Tuple[str, str], Dict] = {}
+
+
+def get_session(pds_url: str, handle: str, password: str) -> Dict:
+    """login to bluesky once and reuse the session for later posts
+
+    Args:
+        pds_url (str): bsky platform (default for now)
+        handle (str): username
+        password (str): app password
+
+    Returns:
+        Dict: json blob with login
+    """
+    key = (pds_url, handle)
+    if key not in _session_cache:
+        _session_cache[key] = bsky_login_session(pds_url, handle, password)
+    return _session_cache[key]
+
+
 def parse_urls(text: str) -> List[Dict]:
     """parse URLs in string blob
 
@@ -48,11 +93,8 @@ def parse_urls(text: str) -> List[Dict]:
         List[Dict]: span of url
     """
     spans = []
-    # partial/naive URL regex based on: https://stackoverflow.com/a/3809435
-    # tweaked to disallow some training punctuation
-    url_regex = rb"[$|\W](https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{1,256}\.[a-zA-Z0-9()]{1,6}\b([-a-zA-Z0-9()@:%_\+.~#?&//=]*[-a-zA-Z0-9@%_\+~#//=])?)"
     text_bytes = text.encode("UTF-8")
-    for m in re.finditer(url_regex, text_bytes):
+    for m in _URL_RE.finditer(text_bytes):
         spans.append(
             {
                 "start": m.start(1),
@@ -101,10 +143,9 @@ def create_post(
         handle (_type_, optional):  Defaults to os.environ["BSKYBOT"]. Set this environmental variable in your dotfile (bashrc/zshrc).
         password (_type_, optional): _description_. Defaults to os.environ["BSKYPWD"].
     """
-    session = bsky_login_session(pds_url, handle, password)
     now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
     # these are the required fields which every post must include
-    post = {
+    post: Dict = {
         "$type": "app.bsky.feed.post",
         "text": text,
         "createdAt": now,
@@ -116,17 +157,33 @@ def create_post(
         if facets:
             post["facets"] = facets
 
-    resp = requests.post(
-        pds_url + "/xrpc/com.atproto.repo.createRecord",
-        headers={"Authorization": "Bearer " + session["accessJwt"]},
-        json={
-            "repo": session["did"],
-            "collection": "app.bsky.feed.post",
-            "record": post,
-        },
-    )
+    for attempt in range(2):
+        session = get_session(pds_url, handle, password)
+        resp = requests.post(
+            pds_url + "/xrpc/com.atproto.repo.createRecord",
+            headers={"Authorization": "Bearer " + session["accessJwt"]},
+            json={
+                "repo": session["did"],
+                "collection": "app.bsky.feed.post",
+                "record": post,
+            },
+        )
+        # expired tokens come back as 400 ExpiredToken, rejected ones as 401
+        expired = resp.status_code == 401
+        if resp.status_code == 400:
+            try:
+                expired = resp.json().get("error") == "ExpiredToken"
+            except ValueError:  # no json body, raise_for_status reports the error
+                pass
+        if not expired or attempt == 1:
+            break
+        # drop the stale session and login again
+        del _session_cache[(pds_url, handle)]
     print("createRecord response:", file=sys.stderr)
-    print(json.dumps(resp.json(), indent=2))
+    try:
+        print(json.dumps(resp.json(), indent=2))
+    except ValueError:
+        print(resp.text)
     resp.raise_for_status()
 
 # %%
@@ -146,96 +203,157 @@ urls = {
 }
 
 
-def get_rss_feed(urls):
-    """Fetch the rss-feeds"""
-    results = {}
-    for k, v in urls.items():
-        f = feedparser.parse(v)
-        results.update(
-            {
-                entry.get("link", ""): {
-                    "title": entry.get("title", ""),
-                    "link": entry.get("link", ""),
-                    "description": entry.get("description", ""),
-                    "journal": k,
-                }
-                for entry in f.entries
-            }
-        )
-    return results
+@dataclass(frozen=True)
+class Paper:
+    """A paper from one of the feeds, as stored in combined.json"""
+
+    # explicit __slots__ rather than dataclass(slots=True), which needs python 3.10
+    __slots__ = ("title", "link", "description", "journal")
+    title: str
+    link: str
+    description: str
+    journal: str
 
 
-def is_valid_paper(title, description):
+def write_json(data: Dict, filename: str):
+    """Write `data` to `filename` atomically
+
+    The json is written to a temporary file that then replaces `filename`, so a
+    crash mid-write leaves the previous version in place instead of a truncated file.
+    """
+    tmp = filename + ".tmp"
+    # serialize in one go rather than letting json.dump issue many small writes
+    with open(tmp, "wb", buffering=1 << 16) as f:
+        f.write(json.dumps(data, indent=2).encode("utf-8"))
+    os.replace(tmp, filename)
+
+
+def get_rss_feed(
+    urls: Dict[str, str], cache_file: str = "feed_cache.json"
+) -> Tuple[Dict[str, Paper], Dict]:
+    """Fetch the rss-feeds and keep the valid papers, with cleaned abstracts
+
+    ETag / Last-Modified values from the previous run are read from `cache_file`
+    and sent along, so unchanged feeds answer with an empty 304. The updated
+    cache is returned rather than saved, so the caller can save it only once
+    the new papers are safely archived.
+    """
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+
+    results = {}
+    # feeds are fetched concurrently, but merged in the order of `urls`
+    # so that posting order stays the same as before
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(urls)))) as ex:
+        futures = {
+            k: ex.submit(
+                feedparser.parse,
+                v,
+                etag=cache.get(v, {}).get("etag"),
+                modified=cache.get(v, {}).get("modified"),
+                # links inside abstracts are dropped with their tags, so there is
+                # no need to rewrite them; sanitizing stays on, since it also drops
+                # <script>/<style> bodies that _TAG_RE would leave behind
+                resolve_relative_uris=False,
+            )
+            for k, v in urls.items()
+        }
+    for k, fut in futures.items():
+        try:
+            f = fut.result()
+        except Exception as e:
+            print(f"Could not fetch {k}: {e}", file=sys.stderr)
+            continue
+        if f.get("status") == 304:  # nothing new since the last run
+            continue
+        if f.get("etag") or f.get("modified"):
+            cache[urls[k]] = {"etag": f.get("etag"), "modified": f.get("modified")}
+        else:
+            cache.pop(urls[k], None)
+        for entry in f.entries:
+            title = entry.get("title", "").strip()
+            description = entry.get("description", "")
+            if is_valid_paper(title, description):
+                link = entry.get("link", "").strip()
+                results[link] = Paper(
+                    title=title,
+                    link=link,
+                    description=clean_abstract(description, k),
+                    journal=k,
+                )
+
+    return results, cache
+
+
+def is_valid_paper(title: str, description: str) -> bool:
     """Check if entry is a valid paper, not a review or other entry"""
-    title_lower = title.lower()
-    return all(
-        [
-            len(title) >= 50,
-            len(description) >= 50,
-            not title_lower.startswith("review"),
-            not title_lower.startswith("corrigendum"),
-        ]
+    return (
+        len(title) >= 50
+        and len(description) >= 50
+        and not title.lower().startswith(("review", "corrigendum"))
     )
 
 
-def clean_abstract(text, journal):
-    text = re.sub(r"<[^>]+>", "", text) # Removes symbols
-    text = re.sub(r"\b(abstract)(\w*)", r"\2", text, flags=re.I) # Removes 'Abstract' from text
+def clean_abstract(text: str, journal: str) -> str:
+    text = _TAG_RE.sub("", text) # Removes symbols
 
-    if journal in [
-        "Socius",
-        "American Sociological Review (AoP)",
-        "American Sociological Review",
-        "Sociological Methodology",
-        "Sociological Methods and Research"
-    ]:
-        text = re.sub(r"^.*?\.", "", text, 1)  # Removes everything up to first "."
+    if journal == "Sociological Science":
+        # runs on the stripped text, so the markers cannot match inside a tag
+        m = _SOCSCI_RE.search(text)
+        if m:
+            text = m.group(1)
 
-    elif journal == "Sociological Science":
-        start = text.find("Abstract")
-        end = text.rfind("Close")
-        text = text[start + len("Abstract") : end].strip()
+    elif journal in _LEADING_DOT_JOURNALS:
+        text = _LEAD_SENTENCE_RE.sub("", text, 1)  # Removes everything up to first "."
 
     text = text.strip()
+    # Removes leading 'Abstract' heading, which may be glued to the first word
+    # ('AbstractScholars'); a lowercase letter after it means a word like 'Abstraction'
+    if text[:8].lower() == "abstract" and not text[8:9].islower():
+        text = text[8:].lstrip()
     return text
 
 
-def filter_results(results):
-    filtered_results = {}
-    for k, v in results.items():
-        if is_valid_paper(v["title"], v["description"]):
-            journal = v.get("journal", "")
-            filtered_results[k] = {
-                **v,
-                "title": v["title"],
-                "description": clean_abstract(v["description"], journal),
-            }
-    return filtered_results
-
 # %%
-def write_json_from_rss(urls=urls, filename="combined.json"):
-    results = get_rss_feed(urls)
-    filtered_results = filter_results(results)
+def write_json_from_rss(
+    urls=urls, filename="combined.json", cache_file="feed_cache.json"
+):
+    filtered_results, cache = get_rss_feed(urls, cache_file)
 
     try:
-        with open(filename, "r") as f:
-            archive = json.load(f)
+        with open(filename, "rb", buffering=1 << 16) as f:
+            archive = {k: Paper(**v) for k, v in json.loads(f.read()).items()}
     except FileNotFoundError:
         archive = {}
 
-    new_archive = archive.copy()
-
-    # Append new items
-    for link, item_data in filtered_results.items():
-        if link not in archive:
-            new_archive[link] = item_data
+    # Append new items; setdefault returns `v` itself only if it was just inserted
+    new_items = {
+        k: v for k, v in filtered_results.items() if archive.setdefault(k, v) is v
+    }
 
-    if len(new_archive) > len(archive):
-        with open(filename, "w") as f:
-            json.dump(new_archive, f, indent=2)
+    if new_items:
+        write_json({k: asdict(v) for k, v in archive.items()}, filename)
         print(f"{filename} updated")
 
-    return filtered_results, archive
+    # only now, otherwise a failed run would get 304s for papers it never archived
+    write_json(cache, cache_file)
+
+    return new_items, archive
+
+
+def format_post(paper: Paper) -> str:
+    """Build the post text for a paper, within bluesky's 300 character limit
+
+    The description is cut to what is left after title and link before joining,
+    instead of joining the full abstract and slicing the result.
+    """
+    head = f"{paper.title}\n{paper.link}\n"
+    description = paper.description[: max(0, 288 - len(head))]
+    post_str = (head + description)[:288] + "\n #sociology"
+    return post_str.replace("\n", " ")
 
 
 def main():
@@ -245,28 +363,19 @@ def main():
     ######################################################################
     new_posts = 0
 
-    # Append new data to existing data
-    for k, v in pull.items():
-        if k not in archive:  # if not already posted
-            post_str = (
-                f"{v['title']}\n{v['link']}\n{''.join(v['description'])}"[:288]
-                + "\n #sociology"
-            )
-            create_post(post_str.replace("\n", " "))
+    # pull only holds papers that were not in the archive, i.e. not yet posted
+    for v in pull.values():
+        # only space posts out; there is nothing to wait for after the last one
+        if new_posts:
             time.sleep(random.randint(60, 300))
-            archive[k] = v
-            new_posts += 1
+        create_post(format_post(v))
+        new_posts += 1
     if new_posts == 0 & (len(archive) > 2):
         print("No new papers found; posting random paper from archive")
-        random_paper = random.choice(list(archive.values()))
-        post_str = (
-            f"{random_paper['title']}\n{random_paper['link']}\n{''.join(random_paper['description'])}"[
-                :288
-            ]
-            + "\n #sociology"
-        )
-        create_post(post_str.replace("\n", " "))
-        time.sleep(random.randint(30, 60))
+        # pick by index so the archive values are not copied into a list
+        idx = random.randrange(len(archive))
+        random_paper = next(islice(archive.values(), idx, None))
+        create_post(format_post(random_paper))
 
 
 # %%